@@ -17,6 +17,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import mmap
 import struct
 import sys
 
@@ -38,7 +39,7 @@ def main() -> int:
             continue
 
         with inputFile:
-            data = inputFile.read()
+            data = read_input(inputFile)
 
         root = build_root_container(data)
         root.print()
@@ -46,9 +47,37 @@ def main() -> int:
     return ERR_OK
 
 
+def read_input(file) -> bytes | memoryview:
+    # map the file rather than reading it in where possible. pipes,
+    # character devices and empty files can't be mapped, so those are
+    # read as normal
+    try:
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return file.read()
+
+    # like read(), start from the current position. this matters for a
+    # redirected stdin which has already been partially consumed
+    return memoryview(mapping)[file.tell():]
+
+
 EXTRA_SPACE_ID    = 0x00
 ROOT_CONTAINER_ID = 0x1d
 
+# "Disc" signature, stored as a little-endian word
+DISC_SIGNATURE    = int.from_bytes(b'csiD', 'little')
+SIGNATURE_OFFSET  = 16
+
+FILE_HEADER       = struct.Struct('<BBHL')
+# signatures and segment table entries are both little-endian words
+WORD              = struct.Struct('<I')
+
+
+def has_disc_signature(data: bytes | memoryview) -> bool:
+    # compare the word in place rather than slicing it out
+    return len(data) >= SIGNATURE_OFFSET + WORD.size \
+            and WORD.unpack_from(data, SIGNATURE_OFFSET)[0] == DISC_SIGNATURE
+
 
 # so that type hints work
 class Element: pass
@@ -58,6 +87,9 @@ class Element:
     def __init__(self):
         self.id = 0xff
         self.elements: list[Element] = []
+        # elements aren't modified after construction, so the
+        # size only needs to be computed once
+        self._blob_size: int | None = None
 
     def header_blob(self) -> bytes:
         return bytes()
@@ -66,38 +98,52 @@ class Element:
         return bytes()
 
     def to_blob(self) -> bytes:
-        blob = self.header_blob()
-        for element in self.elements:
-            blob += element.to_blob()
-        blob += self.footer_blob()
-        return blob
+        parts = [self.header_blob()]
+        parts.extend(element.to_blob() for element in self.elements)
+        parts.append(self.footer_blob())
+        return b''.join(parts)
+
+    def blob_size(self) -> int:
+        if self._blob_size is None:
+            self._blob_size = self._compute_blob_size()
+        return self._blob_size
+
+    def _compute_blob_size(self) -> int:
+        return len(self.header_blob()) \
+                + sum(element.blob_size() for element in self.elements) \
+                + len(self.footer_blob())
 
     def print(self, level: int = 0) -> None:
-        print(f'{"    " * level}{self.__class__.__name__} 0x{self.id:02x}: 0x{len(self.elements):02x} children. size=0x{len(self.to_blob()):06x}')
+        print(f'{"    " * level}{self.__class__.__name__} 0x{self.id:02x}: 0x{len(self.elements):02x} children. size=0x{self.blob_size():06x}')
         for element in self.elements:
             element.print(level + 1)
 
 
 class Blob(Element):
-    def __init__(self, id: int, data: bytes):
+    def __init__(self, id: int, data: bytes | memoryview):
         super().__init__()
         self.id = id
-        self.data = data
+        self.data = bytes(data)
 
     def header_blob(self) -> bytes:
         return self.data
 
+    def _compute_blob_size(self) -> int:
+        return len(self.data)
+
 
 class File(Element):
     CHUNK_SIZE = 0x40
+    HEADER_LENGTH = 8
 
-    def __init__(self, data: bytes):
+    def __init__(self, data: bytes | memoryview, offset: int = 0):
         super().__init__()
 
         self.packed, self.id, self.type, self.unknown, self.size, self.loadAddress = \
-                self.parse_header(data[:8])
+                self.parse_header(data, offset)
 
-        self.blob = data[8:8+self.size]
+        offset += File.HEADER_LENGTH
+        self.blob = bytes(data[offset:offset+self.size])
 
     def header_blob(self) -> bytes:
         fileInfo = 0
@@ -114,18 +160,20 @@ class File(Element):
 
         sizeChunks = len(self.blob) // File.CHUNK_SIZE
 
-        return struct.pack('<BBHL',
+        return FILE_HEADER.pack(
                 fileInfo, sizeBytesAndUnknown, sizeChunks, self.loadAddress)
 
     def footer_blob(self) -> bytes:
         return self.blob
 
+    def _compute_blob_size(self) -> int:
+        return File.HEADER_LENGTH + len(self.blob)
+
     @staticmethod
-    def parse_header(data: bytes):
-        assert len(data) == 8
+    def parse_header(data: bytes | memoryview, offset: int = 0):
         # data is packed together in slightly annoying bit fields
         fileInfo, sizeBytesAndUnknown, sizeChunks, loadAddress = \
-                struct.unpack('<BBHL', data)
+                FILE_HEADER.unpack_from(data, offset)
 
         packed = (fileInfo & 1) == 1    # least significant bit is packed flag
         fileId = (fileInfo >> 1) & 0x0f # followed by 4-bit file id
@@ -140,14 +188,15 @@ class File(Element):
 
 
 class Directory(Element):
-    def __init__(self, id: int, data: bytes):
+    def __init__(self, id: int, data: bytes | memoryview):
         super().__init__()
         self.id = id
 
         offset = 0
-        while offset + 8 <= len(data):
-            file = File(data[offset:])
-            offset += len(file.to_blob())
+        while offset + File.HEADER_LENGTH <= len(data):
+            # step over the file without serialising it again
+            file = File(data, offset)
+            offset += file.blob_size()
             self.elements.append(file)
             if file.id == 0:
                 break
@@ -160,15 +209,15 @@ class Directory(Element):
 class Container(Element):
     PRE_TABLE_HEADER_LENGTH = 32
 
-    def __init__(self, id: int, data: bytes):
+    def __init__(self, id: int, data: bytes | memoryview):
         super().__init__()
         self.id = id
-        self.preSegmentTableHeader = data[:self.PRE_TABLE_HEADER_LENGTH]
+        self.preSegmentTableHeader = bytes(data[:self.PRE_TABLE_HEADER_LENGTH])
 
         self.signature_assert(data)
 
         # parse the table, construct contents
-        _, firstElementOffset = self.parse_entry(data[self.PRE_TABLE_HEADER_LENGTH:self.PRE_TABLE_HEADER_LENGTH+4])
+        _, firstElementOffset = self.parse_entry(data, self.PRE_TABLE_HEADER_LENGTH)
         if firstElementOffset:
             elements = self.get_elements_old(data)
         else:
@@ -188,97 +237,117 @@ class Container(Element):
             if element:
                 self.elements.append(element)
 
-        lastIndex = -1
-        lastId, lastOffset = elements[lastIndex]
-        while lastOffset == 0:
-            lastIndex -= 1
-            _, lastOffset = elements[lastIndex]
+        # the last element runs to the end of the data, starting from the
+        # last entry which has an offset
+        lastId, _ = elements[-1]
+        lastIndex = next((i for i in range(len(elements) - 1, -1, -1) if elements[i][1] != 0), None)
+        if lastIndex is None:
+            raise ValueError('segment table has no non-zero offsets')
+        _, lastOffset = elements[lastIndex]
         lastData = data[lastOffset:]
         if element := self.create_element(lastId, lastData):
             self.elements.append(element)
 
 
-    def get_elements_old(self, data: bytes):
-        _, firstElementOffset = self.parse_entry(data[self.PRE_TABLE_HEADER_LENGTH:self.PRE_TABLE_HEADER_LENGTH+4])
+    def get_elements_old(self, data: bytes | memoryview):
+        _, firstElementOffset = self.parse_entry(data, self.PRE_TABLE_HEADER_LENGTH)
         table = data[self.PRE_TABLE_HEADER_LENGTH:firstElementOffset]
-        return [self.parse_entry(table[i:i+4]) for i in range(0, len(table), 4)]
+        table = table[:len(table) - len(table) % 4]
+        return [(entry & 0xff, entry >> 8) for (entry,) in WORD.iter_unpack(table)]
 
-    def get_elements_new(self, data: bytes):
+    def get_elements_new(self, data: bytes | memoryview):
         elements = []
 
-        table = data[self.PRE_TABLE_HEADER_LENGTH:]
-        tableOffset = 0
+        tableOffset = self.PRE_TABLE_HEADER_LENGTH
         while 1:
-            id, offset = self.parse_entry(table[tableOffset:tableOffset+4])
+            id, offset = self.parse_entry(data, tableOffset)
             elements.append((id, offset))
             if id == EXTRA_SPACE_ID:
                 return elements
             tableOffset += 4
 
-    def signature_assert(self, data: bytes):
+    def signature_assert(self, data: bytes | memoryview):
         pass
 
     @staticmethod
-    def create_element(id: int, data: bytes):
-        if len(data) > 36 and data[16:20] == b'csiD':
+    def create_element(id: int, data: bytes | memoryview):
+        if len(data) > 36 and has_disc_signature(data):
             return DiscContainer(id, data)
 
         if len(data) < 8:
             return Blob(id, data)
 
-        *_, size, loadAddress = File.parse_header(data[:8])
+        *_, size, loadAddress = File.parse_header(data)
         if 0 <= size <= len(data) and loadAddress != 0xffffffff:
             return Directory(id, data)
 
         return Blob(id, data)
 
     @staticmethod
-    def parse_entry(data: bytes) -> tuple[int, int]:
-        assert len(data) == 4
-        data += b'\0'
-        return struct.unpack('<BI', data)
+    def parse_entry(data: bytes | memoryview, offset: int = 0) -> tuple[int, int]:
+        # 8-bit id followed by a 24-bit offset
+        entry, = WORD.unpack_from(data, offset)
+        return entry & 0xff, entry >> 8
 
-    def header_blob(self) -> bytes:
+    def header_length(self) -> int:
         # if the first element is the root container ID, we don't
         # need to build the header blob.
         if self.elements and self.elements[0].id == ROOT_CONTAINER_ID:
+            return 0
+
+        return len(self.preSegmentTableHeader) + 4 * len(self.elements)
+
+    def header_blob(self) -> bytes:
+        if not (headerLength := self.header_length()):
             return bytes()
 
         # construct the segment table.
         # would help to figure out what some of the other parameters are
         # in the first 32 bytes, but not a big deal
-        header = self.preSegmentTableHeader
+        tableOffset = len(self.preSegmentTableHeader)
+        header = bytearray(headerLength)
+        header[:tableOffset] = self.preSegmentTableHeader
 
-        offset = len(header) + 4 * len(self.elements)
+        offset = len(header)
         for element in self.elements:
-            header += struct.pack('<BI', element.id & 0xff, offset & 0xffffffff)[:4]
-            size = len(element.to_blob())
+            # 8-bit id followed by a 24-bit offset, as in parse_entry
+            WORD.pack_into(header, tableOffset,
+                    (element.id & 0xff) | ((offset & 0xffffff) << 8))
+            tableOffset += 4
+            size = element.blob_size()
 
             if size:
                 offset += size
             else:
                 offset = 0
 
-        return header
+        return bytes(header)
+
+    def _compute_blob_size(self) -> int:
+        return self.header_length() + sum(element.blob_size() for element in self.elements)
 
 
 class DiscContainer(Container):
     PRE_TABLE_HEADER_LENGTH = 32
 
-    def signature_assert(self, data: bytes):
-        assert data[16:20] == b'csiD'
+    def signature_assert(self, data: bytes | memoryview):
+        assert has_disc_signature(data)
 
 
 class OldContainer(Container):
     PRE_TABLE_HEADER_LENGTH = 16
 
-    def signature_assert(self, data: bytes):
-        assert data[16:20] != b'csiD'
+    def signature_assert(self, data: bytes | memoryview):
+        assert not has_disc_signature(data)
+
 
+def build_root_container(data: bytes | memoryview):
+    # slices of a memoryview share the underlying buffer, so the image
+    # is only copied where the leaf elements keep hold of their data
+    data = memoryview(data).toreadonly()
 
-def build_root_container(data: bytes):
     # check for "Disc" signature to determine root container type
-    if data[16:20] == b'csiD':
+    if has_disc_signature(data):
         return DiscContainer(ROOT_CONTAINER_ID, data)
     else:
         return OldContainer(ROOT_CONTAINER_ID, data)
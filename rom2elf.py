@@ -23,16 +23,14 @@ import importlib
 import struct
 import sys
 
-from parse import build_root_container, File
-
-uncprs = importlib.import_module("seag-cprs.uncprs")
-unlzma = importlib.import_module("seag-lzma.unlzma")
+from collections import deque
+from collections.abc import Iterator
+from parse import build_root_container, read_input, File
 
 
 ERR_OK        = 0x00
 ERR_USAGE     = 0x01
 ERR_IN_FILE   = 0x02
-ERR_ROM2ELF   = 0x04
 ERR_OUT_FILE  = 0x08
 
 
@@ -73,10 +71,9 @@ def main() -> int:
         return ERR_IN_FILE
 
     with inputFile:
-        inputData = inputFile.read()
+        inputData = read_input(inputFile)
 
-    if not (elf := rom2elf(inputData, extraSegments, args.resolve, args.ignore)):
-        return ERR_ROM2ELF
+    elf = build_elf(inputData, extraSegments, args.resolve, args.ignore)
 
     try:
         outputFile = open(args.outputfile, 'wb') if args.outputfile else sys.stdout.buffer
@@ -85,9 +82,9 @@ def main() -> int:
         return ERR_OUT_FILE
 
     with outputFile:
-        writeCount = outputFile.write(elf)
+        writeCount = elf.write_to(outputFile)
 
-    if writeCount != len(elf):
+    if writeCount != elf.blob_size():
         sys.stderr.write(f'Error: Failed to write all data to file {args.outputfile}\n')
         return ERR_OUT_FILE
 
@@ -98,6 +95,7 @@ def main() -> int:
 OSABI_SYSV    = 0x00
 ET_EXEC       = 0x02
 MACHINE_ARM   = 0x28
+ELF32_HEADER  = struct.Struct('<8B8xHH5I6H')
 
 
 # for program header (segments)
@@ -106,11 +104,13 @@ PT_LOAD       = 0x01
 PF_X          = 0x01
 PF_W          = 0x02
 PF_R          = 0x04
+PROGRAM_HEADER = struct.Struct('<8I')
 
 
 # for section header
 SHT_NULL      = 0x00
 SHF_NONE      = 0x00
+SECTION_HEADER = struct.Struct('<10I')
 
 
 class Elf32:
@@ -122,47 +122,54 @@ class Elf32:
 
     @staticmethod
     def elf32_header(osabi, type, machine, entry, phoff, shoff, flags, phnum, shnum, shstrndx) -> bytes:
-        return struct.pack('<8B8xHH5I6H',
+        return ELF32_HEADER.pack(
                 0x7f, ord('E'), ord('L'), ord('F'), 1, 1, 1, osabi,
                 type, machine, 1, entry, phoff, shoff,
                 flags, 0x34, 0x20, phnum, 0x28, shnum, shstrndx)
 
     @staticmethod
     def program_header(type, offset, vaddr, paddr, filesz, memsz, flags=PF_X|PF_W|PF_R, align=0) -> bytes:
-        return struct.pack('<8I', type, offset, vaddr, paddr, filesz, memsz, flags, align)
+        return PROGRAM_HEADER.pack(type, offset, vaddr, paddr, filesz, memsz, flags, align)
 
     @staticmethod
     def section_header(name, type, flags, addr, offset, size, link, info, addralign, entsize=0) -> bytes:
-        return struct.pack('<10I', name, type, flags, addr, offset, size, link, info, addralign, entsize)
+        return SECTION_HEADER.pack(name, type, flags, addr, offset, size, link, info, addralign, entsize)
 
     def resolve_segment_overlaps(self) -> None:
-        newSegments = [self.segments[0]]
-
-        for data, address in self.segments[1:]:
+        # group segments which overlap (or touch) into contiguous runs,
+        # in order of address
+        order = sorted(range(len(self.segments)), key=lambda i: self.segments[i][1])
+        runs: list[tuple[int, int, list[int]]] = []
+        for i in order:
+            data, address = self.segments[i]
             end = address + len(data)
-            resolved = False
-            for i in range(len(newSegments)):
-                curData, curAddress = newSegments[i]
-                curEnd = curAddress + len(curData)
-
-                # check for an overlap, combining the segments
-                if curAddress <= address <= curEnd or curAddress <= end <= curEnd:
-                    startOffset = max(0, address - curAddress)
-                    endOffset = min(len(curData), end - curAddress)
-                    newSegments[i] = (bytes(curData[:startOffset] + data + curData[endOffset:]), min(address, curAddress))
-                    resolved = True
-                    break
-
-            if not resolved:
-                newSegments.append((data, address))
+            if runs and address <= runs[-1][1]:
+                start, curEnd, indices = runs[-1]
+                indices.append(i)
+                runs[-1] = (start, max(curEnd, end), indices)
+            else:
+                runs.append((address, end, [i]))
+
+        newSegments = []
+        for start, end, indices in runs:
+            if len(indices) == 1:
+                newSegments.append(self.segments[indices[0]])
+                continue
+
+            # later segments take precedence where they overlap
+            buffer = bytearray(end - start)
+            for i in sorted(indices):
+                data, address = self.segments[i]
+                buffer[address - start:address - start + len(data)] = data
+            newSegments.append((bytes(buffer), start))
 
         self.segments = newSegments
 
-    def to_blob(self) -> bytes:
+    def blob_parts(self) -> Iterator[bytes]:
         # offset of the actual data in the segments
         offset = 0x34 + 0x20 * len(self.segments) + 0x28
 
-        blob = self.elf32_header(
+        yield self.elf32_header(
                 OSABI_SYSV, ET_EXEC, MACHINE_ARM, 0,
                 # offsets to program and section header tables
                 0x34, 0x34 + 0x20 * len(self.segments),
@@ -171,18 +178,35 @@ class Elf32:
                 0, 0)
 
         for data, address in self.segments:
-            blob += self.program_header(PT_LOAD, offset, address, 0, len(data), len(data))
+            yield self.program_header(PT_LOAD, offset, address, 0, len(data), len(data))
             offset += len(data)
 
-        blob += self.section_header(0, SHT_NULL, SHF_NONE, 0, 0, 0, 0, 0, 0, 0)
+        yield self.section_header(0, SHT_NULL, SHF_NONE, 0, 0, 0, 0, 0, 0, 0)
 
         for data, address in self.segments:
-            blob += data
+            yield data
+
+    def blob_size(self) -> int:
+        return 0x34 + 0x20 * len(self.segments) + 0x28 \
+                + sum(len(data) for data, _ in self.segments)
+
+    def to_blob(self) -> bytes:
+        return b''.join(self.blob_parts())
+
+    def write_to(self, file) -> int:
+        # write each part out directly rather than building the whole
+        # file in memory first
+        return sum(file.write(part) for part in self.blob_parts())
+
 
-        return blob
+# the decompressors live in submodules, and are only imported once a ROM
+# actually contains packed data
+@functools.cache
+def decompressor(name: str):
+    return importlib.import_module(name)
 
 
-def rom2elf(data: bytes, extraSegments: list[tuple[int, bytes]], resolve=False, ignore: list[int] | None = None) -> bytes:
+def build_elf(data: bytes | memoryview, extraSegments: list[tuple[int, bytes]], resolve=False, ignore: list[int] | None = None) -> Elf32:
     if ignore is None:
         ignore = []
 
@@ -191,17 +215,20 @@ def rom2elf(data: bytes, extraSegments: list[tuple[int, bytes]], resolve=False,
     # find all the Files
     files = []
 
-    toCheck = [root]
+    # breadth-first. the order files are found in sets the order of the
+    # ELF segments, and later segments take precedence when overlaps
+    # are resolved
+    fileType = File
+    toCheck = deque([root])
     while toCheck:
-        newToCheck = []
-        for element in toCheck:
-            if element.id not in ignore:
-                for child in element.elements:
-                    if isinstance(child, File):
-                        files.append(child)
-                    else:
-                        newToCheck.append(child)
-        toCheck = newToCheck
+        element = toCheck.popleft()
+        if element.id in ignore:
+            continue
+        for child in element.elements:
+            if isinstance(child, fileType):
+                files.append(child)
+            else:
+                toCheck.append(child)
 
     elf = Elf32()
 
@@ -209,16 +236,20 @@ def rom2elf(data: bytes, extraSegments: list[tuple[int, bytes]], resolve=False,
     segments += [(a, b, False) for a, b in extraSegments]
 
     for address, data, packed in segments:
-        if packed and data[:4] == b'CPRS':
-            data = uncprs.decompress(data)
-        elif packed and data[:4] == b'LZMA':
-            data = unlzma.decompress(data)
+        if packed and data.startswith(b'CPRS'):
+            data = decompressor("seag-cprs.uncprs").decompress(data)
+        elif packed and data.startswith(b'LZMA'):
+            data = decompressor("seag-lzma.unlzma").decompress(data)
         elf.add_segment(data, address)
 
     if resolve:
         elf.resolve_segment_overlaps()
 
-    return elf.to_blob()
+    return elf
+
+
+def rom2elf(data: bytes | memoryview, extraSegments: list[tuple[int, bytes]], resolve=False, ignore: list[int] | None = None) -> bytes:
+    return build_elf(data, extraSegments, resolve, ignore).to_blob()
 
 
 if __name__ == '__main__':